@@ -438,7 +438,7 @@ if __name__ == "__main__":
                 os.system(f"mkdir -p {path}")
 
         print("Setting tc netem qdiscs...")
-        utils.net.clear_tc_qdisc_netems_main(remotes=remotes, capture_stderr=True)
+        utils.net.clear_tc_qdisc_netems_main(remotes=remotes, discard_stderr=True)
         utils.net.set_tc_qdisc_netems_main(
             NETEM_MEAN_A,
             NETEM_JITTER_A,
@@ -778,7 +778,7 @@ if __name__ == "__main__":
                 if this_env.group != last_env_group:
                     print("Setting tc netem qdiscs...")
                     utils.net.clear_tc_qdisc_netems_main(
-                        remotes=remotes, capture_stderr=True
+                        remotes=remotes, discard_stderr=True
                     )
                     utils.net.set_tc_qdisc_netems_main(
                         this_env.delay,
@@ -3,6 +3,10 @@ import sys
 import argparse
 import subprocess
 import math
+import time
+import pickle
+import hashlib
+import tempfile
 
 sys.path.append(os.path.dirname(os.path.realpath(__file__)))
 import utils
@@ -12,6 +16,9 @@ MANAGER_LOOP_IP = "127.0.0.1"
 MANAGER_VETH_IP = "10.0.0.0"
 MANAGER_CLI_PORT = 30009  # NOTE: assuming at most 9 servers
 
+CLI_CACHE_PATH = os.path.expanduser("~/.cache/summerset/cli-cache.pkl")
+CLI_CACHE_MAX_ENTRIES = 16
+
 
 CLIENT_OUTPUT_PATH = (
     lambda protocol, prefix, midfix, i: f"{prefix}/{protocol}{midfix}.{i}.out"
@@ -49,28 +56,75 @@ UTILITY_PARAM_NAMES = {
 }
 
 
-def run_process_pinned(i, cmd, cores_per_proc=0):
-    cpu_list = None
-    if cores_per_proc != 0:
-        # get number of processors
-        num_cpus = utils.proc.get_cpu_count()
-        # parse cores_per_proc setting
-        if cores_per_proc != int(cores_per_proc) and (
-            cores_per_proc > 1 or cores_per_proc < -1
-        ):
-            raise ValueError(f"invalid cores_per_proc {cores_per_proc}")
+def check_cores_per_proc(cores_per_proc):
+    if cores_per_proc != int(cores_per_proc) and (
+        cores_per_proc > 1 or cores_per_proc < -1
+    ):
+        raise ValueError(f"invalid cores_per_proc {cores_per_proc}")
+
+
+def compute_cpu_list(i, cores_per_proc, cores):
+    num_cpus = len(cores)
+    if cores_per_proc == int(cores_per_proc):
+        # integer case: plain integer arithmetic suffices
+        num_cores = int(abs(cores_per_proc))
         if cores_per_proc < 0:
             # negative means starting from CPU 0 (instead from last)
-            cores_per_proc *= -1
-            core_start = math.floor(i * cores_per_proc)
-            core_end = math.ceil(core_start + cores_per_proc - 1)
-            assert core_end < num_cpus
+            core_start = i * num_cores
+            core_end = core_start + num_cores - 1
         else:
             # else pin client cores from last CPU down
-            core_end = math.ceil(num_cpus - 1 - i * cores_per_proc)
-            core_start = math.floor(core_end - cores_per_proc + 1)
-            assert core_start >= 0
-        cpu_list = f"{core_start}-{core_end}"
+            core_end = num_cpus - 1 - i * num_cores
+            core_start = core_end - num_cores + 1
+    elif cores_per_proc < 0:
+        # fractional case: multiple clients share the same core
+        cores_per_proc *= -1
+        core_start = math.floor(i * cores_per_proc)
+        core_end = math.ceil(core_start + cores_per_proc - 1)
+    else:
+        core_end = math.ceil(num_cpus - 1 - i * cores_per_proc)
+        core_start = math.floor(core_end - cores_per_proc + 1)
+    assert core_start >= 0 and core_end < num_cpus
+    return utils.proc.format_cpu_list(cores[core_start : core_end + 1])
+
+
+def node_capacity(cores_per_proc, num_cores):
+    if cores_per_proc == int(cores_per_proc):
+        return num_cores // int(abs(cores_per_proc))
+    else:
+        return math.floor(num_cores / abs(cores_per_proc))
+
+
+def compute_cpu_lists(num_clients, cores_per_proc):
+    # fill NUMA nodes one after another by capacity, keeping each client's
+    # cores within a single node; only physical cores are considered
+    physical = set(utils.proc.get_physical_cores())
+    nodes = [
+        [c for c in node if c in physical] for node in utils.proc.get_numa_nodes()
+    ]
+    nodes = [node for node in nodes if len(node) > 0]
+    if cores_per_proc > 0:
+        # positive means pinning from the last CPU down, so start from the
+        # last node as well to stay clear of servers pinned from CPU 0 up
+        nodes.reverse()
+
+    capacity = sum(node_capacity(cores_per_proc, len(node)) for node in nodes)
+    if num_clients > capacity:
+        num_usable = sum(len(node) for node in nodes)
+        raise ValueError(
+            f"cannot pin {num_clients} clients with pin_cores {cores_per_proc}: "
+            f"only {num_usable} usable cores (fits {capacity} clients)"
+        )
+
+    cpu_lists = []
+    for node in nodes:
+        fits = node_capacity(cores_per_proc, len(node))
+        for i in range(min(fits, num_clients - len(cpu_lists))):
+            cpu_lists.append(compute_cpu_list(i, cores_per_proc, node))
+    return cpu_lists
+
+
+def run_process_pinned(cmd, cpu_list=None):
     return utils.proc.run_process(cmd, cpu_list=cpu_list)
 
 
@@ -116,7 +170,10 @@ def compose_client_cmd(
 
     cmd += ["-u", utility]
     if output_path is not None:
-        params = "+".join([f"output_path='{output_path}'", params])
+        if len(params) > 0:
+            params = f"output_path='{output_path}'+{params}"
+        else:
+            params = f"output_path='{output_path}'"
     if len(params) > 0:
         cmd += ["--params", params]
 
@@ -143,12 +200,17 @@ def run_clients(
     if num_clients < 1:
         raise ValueError(f"invalid num_clients: {num_clients}")
 
+    # compute each client's CPU set once up front
+    cpu_lists = [None] * num_clients
+    if pin_cores != 0:
+        check_cores_per_proc(pin_cores)
+        cpu_lists = compute_cpu_lists(num_clients, pin_cores)
+
+    manager_ip = MANAGER_VETH_IP if use_veth else MANAGER_LOOP_IP
+    manager_addr = f"{manager_ip}:{MANAGER_CLI_PORT}"
+
     client_procs = []
     for i in range(num_clients):
-        manager_addr = f"{MANAGER_LOOP_IP}:{MANAGER_CLI_PORT}"
-        if use_veth:
-            manager_addr = f"{MANAGER_VETH_IP}:{MANAGER_CLI_PORT}"
-
         cmd = compose_client_cmd(
             protocol,
             manager_addr,
@@ -164,15 +226,13 @@ def run_clients(
             ),
         )
 
-        proc = run_process_pinned(i, cmd, cores_per_proc=pin_cores)
+        proc = run_process_pinned(cmd, cpu_list=cpu_lists[i])
         client_procs.append(proc)
 
     return client_procs
 
 
-if __name__ == "__main__":
-    utils.file.check_proper_cwd()
-
+def build_arg_parser():
     parser = argparse.ArgumentParser(allow_abbrev=False)
     parser.add_argument(
         "-p", "--protocol", type=str, required=True, help="protocol name"
@@ -299,7 +359,55 @@ if __name__ == "__main__":
         help="colon-separated pair of key & value as a single-shot write",
     )
 
-    args = parser.parse_args()
+    return parser
+
+
+def load_cli_cache():
+    # cache is invalidated whenever this script itself gets modified
+    try:
+        with open(CLI_CACHE_PATH, "rb") as f:
+            cache = pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        return dict()
+    if cache.get("mtime") != os.path.getmtime(__file__):
+        return dict()
+    return cache["entries"]
+
+
+def store_cli_cache(entries):
+    while len(entries) > CLI_CACHE_MAX_ENTRIES:
+        del entries[next(iter(entries))]
+
+    # write to a temp file then atomically replace, as concurrent runs may
+    # be reading or writing the same cache file
+    cache_dir = os.path.dirname(CLI_CACHE_PATH)
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix=".tmp")
+    except OSError:
+        return
+    try:
+        with os.fdopen(fd, "wb") as f:
+            cache = {"mtime": os.path.getmtime(__file__), "entries": entries}
+            pickle.dump(cache, f)
+        os.replace(tmp_path, CLI_CACHE_PATH)
+    except OSError:
+        os.unlink(tmp_path)
+
+
+if __name__ == "__main__":
+    utils.file.check_proper_cwd()
+
+    # reuse parsed arguments of an identical earlier invocation, if any
+    cli_key = hashlib.sha1("\x00".join(sys.argv[1:]).encode()).hexdigest()
+    cli_cache = load_cli_cache()
+    if cli_key in cli_cache:
+        args, params = cli_cache[cli_key]
+    else:
+        args = build_arg_parser().parse_args()
+        params = glue_params_str(args, UTILITY_PARAM_NAMES[args.utility])
+        cli_cache[cli_key] = (args, params)
+        store_cli_cache(cli_cache)
 
     # check that number of clients does not exceed 99
     if args.utility == "bench":
@@ -314,7 +422,7 @@ if __name__ == "__main__":
         and len(args.output_prefix) > 0
         and not os.path.isdir(args.output_prefix)
     ):
-        os.system(f"mkdir -p {args.output_prefix}")
+        os.makedirs(args.output_prefix, exist_ok=True)
 
     # build everything
     if not args.skip_build:
@@ -326,7 +434,7 @@ if __name__ == "__main__":
         args.protocol,
         args.utility,
         args.num_clients if args.utility == "bench" else 1,
-        glue_params_str(args, UTILITY_PARAM_NAMES[args.utility]),
+        params,
         args.release,
         args.config,
         "" if args.utility != "bench" else args.output_prefix,
@@ -343,15 +451,31 @@ if __name__ == "__main__":
             timeout = 600
         else:
             timeout = args.length_s + 30
-    try:
-        rcs = []
-        for i, client_proc in enumerate(client_procs):
-            rcs.append(client_proc.wait(timeout=timeout))
-    except subprocess.TimeoutExpired:
-        if args.expect_halt:  # mainly for failover experiments
-            print("WARN: getting expected halt, exiting...")
-            sys.exit(0)
-        raise RuntimeError(f"some client(s) timed-out {timeout} secs")
+
+    # reap clients in completion order against one shared deadline, so the
+    # whole wait is bounded by timeout rather than #clients * timeout
+    deadline = None if timeout is None else time.monotonic() + timeout
+    pending = {i: proc for i, proc in enumerate(client_procs)}
+    rcs = [None] * len(client_procs)
+    while len(pending) > 0:
+        if deadline is not None and time.monotonic() >= deadline:
+            for proc in pending.values():
+                proc.terminate()
+            for proc in pending.values():
+                try:
+                    proc.wait(timeout=1)
+                except subprocess.TimeoutExpired:
+                    proc.kill()
+            if args.expect_halt:  # mainly for failover experiments
+                print("WARN: getting expected halt, exiting...")
+                sys.exit(0)
+            raise RuntimeError(f"some client(s) timed-out {timeout} secs")
+
+        done = [i for i, proc in pending.items() if proc.poll() is not None]
+        for i in done:
+            rcs[i] = pending.pop(i).returncode
+        if len(done) == 0:
+            time.sleep(0.05)
 
     if any(map(lambda rc: rc != 0, rcs)):
         sys.exit(1)
@@ -104,7 +104,7 @@ if __name__ == "__main__":
 
     if args.netem_asym:
         print("Setting tc netem qdiscs...")
-        utils.net.clear_tc_qdisc_netems_main(remotes=remotes, capture_stderr=True)
+        utils.net.clear_tc_qdisc_netems_main(remotes=remotes, discard_stderr=True)
         utils.net.set_tc_qdisc_netems_asym(
             PAIRS_NETEM_MEAN,
             PAIRS_NETEM_JITTER,
@@ -39,12 +39,31 @@ def killall_on_targets(
                     cd_dir=cd_dir,
                     capture_stdout=True,
                     capture_stderr=True,
+                    multiplex=True,
                 )
             )
         print("Waiting for command results...")
         utils.proc.wait_parallel_procs(procs)
 
 
+def resolve_destinations(group, targets_str):
+    base, repo, _, remotes, _, _ = utils.config.parse_toml_file(TOML_FILENAME, group)
+
+    targets = utils.config.parse_comma_separated(targets_str)
+    destinations = []
+    if targets_str == "all":
+        destinations = list(remotes.values())
+    else:
+        for target in targets:
+            if target not in remotes:
+                raise ValueError(f"nickname '{target}' not found in toml file")
+            destinations.append(remotes[target])
+    if len(destinations) == 0:
+        raise ValueError(f"targets list is empty")
+
+    return destinations, f"{base}/{repo}"
+
+
 if __name__ == "__main__":
     utils.file.check_proper_cwd()
 
@@ -73,25 +92,11 @@ if __name__ == "__main__":
     )
     args = parser.parse_args()
 
-    base, repo, _, remotes, _, _ = utils.config.parse_toml_file(
-        TOML_FILENAME, args.group
-    )
-
-    targets = utils.config.parse_comma_separated(args.targets)
-    destinations = []
-    if args.targets == "all":
-        destinations = list(remotes.values())
-    else:
-        for target in targets:
-            if target not in remotes:
-                raise ValueError(f"nickname '{target}' not found in toml file")
-            destinations.append(remotes[target])
-    if len(destinations) == 0:
-        raise ValueError(f"targets list is empty")
+    destinations, cd_dir = resolve_destinations(args.group, args.targets)
 
     killall_on_targets(
         destinations,
-        f"{base}/{repo}",
+        cd_dir,
         args.chain,
         args.cockroach,
         args.zookeeper,
@@ -0,0 +1,46 @@
+import sys
+import os
+import json
+
+sys.path.append(os.path.dirname(os.path.realpath(__file__)))
+import utils
+from remote_killall import resolve_destinations, killall_on_targets
+
+
+# Long-running variant of remote_killall.py: reads one JSON-encoded request
+# per line from stdin, e.g., {"group": "reg", "targets": "all", "chain": false},
+# performs the kills, then writes back one JSON ACK line. Exits on EOF.
+
+
+def handle_request(req):
+    destinations, cd_dir = resolve_destinations(
+        req.get("group", "reg"), req.get("targets", "all")
+    )
+    killall_on_targets(
+        destinations,
+        cd_dir,
+        chain=req.get("chain", False),
+        cockroach=req.get("cockroach", False),
+        zookeeper=req.get("zookeeper", False),
+        etcd=req.get("etcd", False),
+    )
+
+
+if __name__ == "__main__":
+    # keep stdout exclusively for ACKs; progress prints go to stderr
+    ack_out = sys.stdout
+    sys.stdout = sys.stderr
+
+    utils.file.check_proper_cwd()
+
+    for line in sys.stdin:
+        if len(line.strip()) == 0:
+            continue
+        try:
+            handle_request(json.loads(line))
+            ack = {"ok": True}
+        except (Exception, SystemExit) as e:
+            # e.g., config parsing calls sys.exit() on an unknown group
+            ack = {"ok": False, "error": str(e) or type(e).__name__}
+        ack_out.write(json.dumps(ack) + "\n")
+        ack_out.flush()
@@ -97,4 +97,5 @@ echo
 echo "Installing necessary pip packages..."
 pip3 install numpy \
              matplotlib \
-             toml
+             toml \
+             psutil
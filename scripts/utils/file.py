@@ -63,9 +63,10 @@ def clear_fs_caches(remotes=None):
                 run_process_over_ssh(
                     remotes[host],
                     cmd,
-                    capture_stdout=True,
-                    capture_stderr=True,
+                    discard_stdout=True,
+                    discard_stderr=True,
                     print_cmd=False,
+                    multiplex=True,
                 )
             )
         wait_parallel_procs(procs, list(remotes.keys()), check_rc=False)
@@ -88,9 +89,10 @@ def remove_files_in_dir(path, remotes=None):
                 run_process_over_ssh(
                     remotes[host],
                     cmd,
-                    capture_stdout=True,
-                    capture_stderr=True,
+                    discard_stdout=True,
+                    discard_stderr=True,
                     print_cmd=False,
+                    multiplex=True,
                 )
             )
         wait_parallel_procs(procs, list(remotes.keys()), check_rc=False)
@@ -1,12 +1,15 @@
 import sys
 import os
 import time
+import shlex
+import socket
+import functools
 
 sys.path.append(os.path.dirname(os.path.realpath(__file__)))
 from proc import run_process, run_process_over_ssh, wait_parallel_procs
 
 
-def lookup_dns_to_ip(domain):
+def lookup_dns_to_ip_dig(domain):
     proc = run_process(["dig", "+short", domain], capture_stdout=True, print_cmd=False)
     out, _ = proc.communicate()
     out = out.decode().strip()
@@ -18,19 +21,68 @@ def lookup_dns_to_ip(domain):
     return ip
 
 
-def get_interface_name(remote=None):
+@functools.lru_cache(maxsize=256)
+def lookup_dns_to_ip(domain):
+    # set SUMMERSET_DNS_USE_DIG=1 to query DNS directly through dig, skipping
+    # local resolver sources such as /etc/hosts
+    if os.environ.get("SUMMERSET_DNS_USE_DIG", "0") not in ("", "0"):
+        return lookup_dns_to_ip_dig(domain)
+
+    try:
+        addrs = socket.getaddrinfo(domain, None, socket.AF_INET)
+    except socket.gaierror:
+        raise RuntimeError(f"dns lookup for {domain} failed")
+
+    # /etc/hosts often maps a host's own FQDN to a loopback address such as
+    # 127.0.1.1, which is useless for cross-host runs; ask DNS instead then
+    for addr in addrs:
+        ip = addr[4][0]
+        if not ip.startswith("127."):
+            return ip
+    return lookup_dns_to_ip_dig(domain)
+
+
+def parse_interface_name(out):
+    out = out.decode().strip()
+    segs = out.split()
+    assert len(segs) >= 5
+    return segs[4]
+
+
+def launch_interface_name_query(remote=None):
     cmd = ["ip", "-o", "-4", "route", "show", "to", "default"]
-    proc = None
     if remote is None:
-        proc = run_process(cmd, capture_stdout=True, print_cmd=False)
+        return run_process(cmd, capture_stdout=True, print_cmd=False)
     else:
-        proc = run_process_over_ssh(remote, cmd, capture_stdout=True, print_cmd=False)
+        return run_process_over_ssh(
+            remote, cmd, capture_stdout=True, print_cmd=False, multiplex=True
+        )
+
+
+# interface names do not change during a run, so remember them per remote
+interface_names_cache = dict()
+
+
+def get_interface_name(remote=None):
+    if remote in interface_names_cache:
+        return interface_names_cache[remote]
+    proc = launch_interface_name_query(remote=remote)
     out, _ = proc.communicate()
-    out = out.decode().strip()
+    interface_names_cache[remote] = parse_interface_name(out)
+    return interface_names_cache[remote]
 
-    segs = out.split()
-    assert len(segs) >= 5
-    return segs[4]
+
+def prime_interface_cache(remotes):
+    missing = [r for r in dict.fromkeys(remotes) if r not in interface_names_cache]
+    procs = [launch_interface_name_query(remote=r) for r in missing]
+    wait_parallel_procs(procs, check_rc=False)
+    for remote, proc in zip(missing, procs):
+        interface_names_cache[remote] = parse_interface_name(proc.stdout.read())
+
+
+def get_interface_names(remotes):
+    prime_interface_cache(remotes)
+    return {r: interface_names_cache[r] for r in remotes}
 
 
 def set_tc_qdisc_netem(
@@ -66,6 +118,7 @@ def set_tc_qdisc_netem(
             remote,
             cmd,
             print_cmd=False,
+            multiplex=True,
         )
 
 
@@ -81,7 +134,8 @@ def set_tc_qdisc_netems_veth(
     involve_ifb=False,
     remote=None,
 ):
-    for replica in range(num_replicas):
+    # dev and ifb qdiscs are independent, so set all of them in parallel
+    dev_procs = [
         set_tc_qdisc_netem(
             netns(replica),
             dev(replica),
@@ -90,7 +144,10 @@ def set_tc_qdisc_netems_veth(
             rate(replica),
             distribution=distribution,
             remote=remote,
-        ).wait()
+        )
+        for replica in range(num_replicas)
+    ]
+    ifb_procs = [
         set_tc_qdisc_netem(
             netns(replica),
             ifb(replica),
@@ -98,7 +155,10 @@ def set_tc_qdisc_netems_veth(
             0,
             rate(replica) if involve_ifb else 0,
             remote=remote,
-        ).wait()
+        )
+        for replica in range(num_replicas)
+    ]
+    wait_parallel_procs(dev_procs + ifb_procs, check_rc=False)
 
 
 def set_tc_qdisc_netems_main(
@@ -108,13 +168,14 @@ def set_tc_qdisc_netems_main(
         remotes = [None]
     else:
         remotes = [remotes[h] for h in sorted(list(remotes.keys()))]
+    ifnames = get_interface_names(remotes)
 
     procs = []
     for replica, remote in enumerate(remotes):
         procs.append(
             set_tc_qdisc_netem(
                 None,
-                get_interface_name(remote=remote),
+                ifnames[remote],
                 mean(replica),
                 jitter(replica),
                 rate(replica),
@@ -140,7 +201,7 @@ def set_tc_qdisc_netems_main(
     wait_parallel_procs(procs, check_rc=False)
 
 
-def add_tc_qdisc_prio_base(dev, num_bands=4, remote=None):
+def compose_tc_qdisc_prio_base_cmd(dev, num_bands=4):
     assert num_bands > 3
 
     cmd = [
@@ -156,7 +217,11 @@ def add_tc_qdisc_prio_base(dev, num_bands=4, remote=None):
         "bands",
         str(num_bands),
     ]
-    cmd = ["sudo"] + cmd
+    return ["sudo"] + cmd
+
+
+def add_tc_qdisc_prio_base(dev, num_bands=4, remote=None):
+    cmd = compose_tc_qdisc_prio_base_cmd(dev, num_bands=num_bands)
 
     if remote is None:
         return run_process(cmd)
@@ -165,17 +230,12 @@ def add_tc_qdisc_prio_base(dev, num_bands=4, remote=None):
             remote,
             cmd,
             print_cmd=False,
+            multiplex=True,
         )
 
 
-def add_tc_qdisc_band_netem(
-    dev,
-    mean,
-    jitter,
-    rate,
-    distribution="pareto",
-    flowid="1:4",
-    remote=None,
+def compose_tc_qdisc_band_netem_cmd(
+    dev, mean, jitter, rate, distribution="pareto", flowid="1:4"
 ):
     assert flowid.count(":") == 1 and flowid[-1] != ":"
     child = flowid.split(":")[-1] + "0:"
@@ -200,7 +260,21 @@ def add_tc_qdisc_band_netem(
         jitter_args,
         rate_args,
     ]
-    cmd = ["sudo"] + cmd
+    return ["sudo"] + cmd
+
+
+def add_tc_qdisc_band_netem(
+    dev,
+    mean,
+    jitter,
+    rate,
+    distribution="pareto",
+    flowid="1:4",
+    remote=None,
+):
+    cmd = compose_tc_qdisc_band_netem_cmd(
+        dev, mean, jitter, rate, distribution=distribution, flowid=flowid
+    )
 
     if remote is None:
         return run_process(cmd)
@@ -209,12 +283,11 @@ def add_tc_qdisc_band_netem(
             remote,
             cmd,
             print_cmd=False,
+            multiplex=True,
         )
 
 
-def add_tc_filter_for_ip_dst(
-    dev, ip_dst, higher_ports=False, flowid="1:4", remote=None
-):
+def compose_tc_filter_for_ip_dst_cmd(dev, ip_dst, higher_ports=False, flowid="1:4"):
     assert flowid.count(":") == 1 and flowid[-1] != ":"
 
     cmd = [
@@ -249,7 +322,15 @@ def add_tc_filter_for_ip_dst(
         "flowid",
         flowid,
     ]
-    cmd = ["sudo"] + cmd
+    return ["sudo"] + cmd
+
+
+def add_tc_filter_for_ip_dst(
+    dev, ip_dst, higher_ports=False, flowid="1:4", remote=None
+):
+    cmd = compose_tc_filter_for_ip_dst_cmd(
+        dev, ip_dst, higher_ports=higher_ports, flowid=flowid
+    )
 
     if remote is None:
         return run_process(cmd)
@@ -258,7 +339,45 @@ def add_tc_filter_for_ip_dst(
             remote,
             cmd,
             print_cmd=False,
+            multiplex=True,
+        )
+
+
+def build_tc_script_asym(
+    dev,
+    host,
+    host_idx,
+    ipaddrs,
+    pairs_mean,
+    pairs_jitter,
+    pairs_rate,
+    distribution="pareto",
+    higher_ports=False,
+):
+    # base prio qdisc first, as both the per-peer child netem qdiscs and the
+    # filter rules attach to its bands
+    cmds = [compose_tc_qdisc_prio_base_cmd(dev, num_bands=3 + len(host_idx))]
+    for peer in host_idx:
+        cmds.append(
+            compose_tc_qdisc_band_netem_cmd(
+                dev,
+                pairs_mean.get(host, peer),
+                pairs_jitter.get(host, peer),
+                pairs_rate.get(host, peer),
+                distribution=distribution,
+                flowid=f"1:{3 + host_idx[peer] + 1}",
+            )
+        )
+    for peer, peer_ip in ipaddrs.items():
+        cmds.append(
+            compose_tc_filter_for_ip_dst_cmd(
+                dev,
+                peer_ip,
+                higher_ports=higher_ports,
+                flowid=f"1:{3 + host_idx[peer] + 1}",
+            )
         )
+    return "; ".join(" ".join(cmd) for cmd in cmds)
 
 
 def set_tc_qdisc_netems_asym(
@@ -277,54 +396,35 @@ def set_tc_qdisc_netems_asym(
     assert remotes is not None and len(remotes) > 1
     assert len(ipaddrs) == len(remotes)
     host_idx = {h: i for i, h in enumerate(sorted(list(remotes.keys())))}
-    main_dev = {h: get_interface_name(remote=remote) for h, remote in remotes.items()}
+    ifnames = get_interface_names(list(remotes.values()))
+    main_dev = {h: ifnames[remote] for h, remote in remotes.items()}
 
+    # run each host's whole tc setup as one script over a single SSH session
     procs = []
     for host, remote in remotes.items():
-        # add base prio qdisc
+        script = build_tc_script_asym(
+            main_dev[host],
+            host,
+            host_idx,
+            ipaddrs,
+            pairs_mean,
+            pairs_jitter,
+            pairs_rate,
+            distribution=distribution,
+            higher_ports=higher_ports,
+        )
         procs.append(
-            add_tc_qdisc_prio_base(
-                main_dev[host],
-                num_bands=3 + len(remotes),
-                remote=remote,
+            run_process_over_ssh(
+                remote,
+                ["bash", "-c", shlex.quote(script)],
+                print_cmd=False,
+                multiplex=True,
             )
         )
     wait_parallel_procs(procs, check_rc=False)
 
-    procs = []
-    for host, remote in remotes.items():
-        # add per-peer child netem qdiscs
-        for peer in remotes.keys():
-            procs.append(
-                add_tc_qdisc_band_netem(
-                    main_dev[host],
-                    pairs_mean.get(host, peer),
-                    pairs_jitter.get(host, peer),
-                    pairs_rate.get(host, peer),
-                    distribution=distribution,
-                    flowid=f"1:{3 + host_idx[peer] + 1}",
-                    remote=remote,
-                )
-            )
-    wait_parallel_procs(procs, check_rc=False)
-
-    procs = []
-    for host, remote in remotes.items():
-        # add filter rules for each peer
-        for peer, peer_ip in ipaddrs.items():
-            procs.append(
-                add_tc_filter_for_ip_dst(
-                    main_dev[host],
-                    peer_ip,
-                    higher_ports=higher_ports,
-                    flowid=f"1:{3 + host_idx[peer] + 1}",
-                    remote=remote,
-                )
-            )
-    wait_parallel_procs(procs, check_rc=False)
-
 
-def clear_tc_qdisc_netem(netns, dev, remote=None, capture_stderr=False):
+def clear_tc_qdisc_netem(netns, dev, remote=None, discard_stderr=False):
     cmd = [
         "tc",
         "qdisc",
@@ -350,48 +450,56 @@ def clear_tc_qdisc_netem(netns, dev, remote=None, capture_stderr=False):
         cmd = ["sudo"] + cmd
 
     if remote is None:
-        return run_process(cmd, capture_stderr=capture_stderr)
+        return run_process(cmd, discard_stderr=discard_stderr)
     else:
         return run_process_over_ssh(
             remote,
             cmd,
             print_cmd=False,
-            capture_stderr=capture_stderr,
+            discard_stderr=discard_stderr,
+            multiplex=True,
         )
 
 
 def clear_tc_qdisc_netems_veth(
-    num_replicas, netns, dev, ifb, remote=None, capture_stderr=False
+    num_replicas, netns, dev, ifb, remote=None, discard_stderr=False
 ):
-    for replica in range(num_replicas):
+    dev_procs = [
         clear_tc_qdisc_netem(
             netns(replica),
             dev(replica),
             remote=remote,
-            capture_stderr=capture_stderr,
-        ).wait()
+            discard_stderr=discard_stderr,
+        )
+        for replica in range(num_replicas)
+    ]
+    ifb_procs = [
         clear_tc_qdisc_netem(
             netns(replica),
             ifb(replica),
             remote=remote,
-            capture_stderr=capture_stderr,
-        ).wait()
+            discard_stderr=discard_stderr,
+        )
+        for replica in range(num_replicas)
+    ]
+    wait_parallel_procs(dev_procs + ifb_procs, check_rc=False)
 
 
-def clear_tc_qdisc_netems_main(remotes=None, capture_stderr=False):
+def clear_tc_qdisc_netems_main(remotes=None, discard_stderr=False):
     if remotes is None:
         remotes = [None]
     else:
         remotes = [remotes[h] for h in sorted(list(remotes.keys()))]
+    ifnames = get_interface_names(remotes)
 
     procs = []
     for remote in remotes:
         procs.append(
             clear_tc_qdisc_netem(
                 None,
-                get_interface_name(remote=remote),
+                ifnames[remote],
                 remote=remote,
-                capture_stderr=capture_stderr,
+                discard_stderr=discard_stderr,
             )
         )
     wait_parallel_procs(procs, check_rc=False)
@@ -403,7 +511,7 @@ def clear_tc_qdisc_netems_main(remotes=None, capture_stderr=False):
                 None,
                 "ifbe",
                 remote=remote,
-                capture_stderr=capture_stderr,
+                discard_stderr=discard_stderr,
             )
         )
     wait_parallel_procs(procs, check_rc=False)
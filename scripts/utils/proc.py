@@ -1,13 +1,57 @@
 import os
+import time
+import json
+import signal
+import shlex
 import subprocess
 import multiprocessing
 
 
-def kill_all_matching(name):
+SSH_OPTIONS = ["-o", "StrictHostKeyChecking=no"]
+
+# opt-in multiplexing of short-lived SSH commands over one persistent master
+# connection per host; not for long-running sessions (servers, clients), as
+# sshd caps sessions per connection (MaxSessions)
+SSH_MUX_OPTIONS = [
+    "-o",
+    "ControlMaster=auto",
+    "-o",
+    "ControlPath=/tmp/ssh-mux-%r@%h:%p",
+    "-o",
+    "ControlPersist=60s",
+]
+
+
+def kill_all_matching(name, use_sudo=False):
     print("Kill all:", name)
     assert name.count(" ") == 0
-    cmd = f"sudo killall -9 {name} > /dev/null 2>&1"
-    os.system(cmd)
+    if not use_sudo:
+        try:
+            import psutil
+        except ImportError:
+            use_sudo = True
+    if use_sudo:
+        cmd = f"sudo killall -9 {name} > /dev/null 2>&1"
+        os.system(cmd)
+        return
+
+    # send SIGKILL directly; processes owned by another user (e.g., servers
+    # launched under sudo ip netns exec) are handed to a single sudo kill
+    denied = []
+    for p in psutil.process_iter(attrs=["pid", "name"]):
+        if p.info["name"] == name:
+            try:
+                os.kill(p.info["pid"], signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+            except PermissionError:
+                denied.append(str(p.info["pid"]))
+    if len(denied) > 0:
+        subprocess.Popen(
+            ["sudo", "kill", "-9"] + denied,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        ).wait()
 
 
 def kill_all_local_procs():
@@ -16,27 +60,62 @@ def kill_all_local_procs():
     os.system(cmd)
 
 
+# persistent remote_killall_daemon.py helper, spawned on first use so that
+# repeated kills skip the Python interpreter startup
+killall_daemon = None
+
+
 def kill_all_distr_procs(
     group, targets="all", chain=False, cockroach=False, etcd=False, zookeeper=False
 ):
     # print(f"Killing all procs on {group} {targets}...")
-    cmd = [
-        "python3",
-        "scripts/remote_killall.py",
-        "-g",
-        group,
-        "-t",
-        targets,
-    ]
-    if chain:
-        cmd.append("--chain")
-    if cockroach:
-        cmd.append("--cockroach")
-    if etcd:
-        cmd.append("--etcd")
-    if zookeeper:
-        cmd.append("--zookeeper")
-    subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).wait()
+    global killall_daemon
+    if killall_daemon is None or killall_daemon.poll() is not None:
+        killall_daemon = subprocess.Popen(
+            ["python3", "scripts/remote_killall_daemon.py"],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+        )
+
+    req = {
+        "group": group,
+        "targets": targets,
+        "chain": chain,
+        "cockroach": cockroach,
+        "etcd": etcd,
+        "zookeeper": zookeeper,
+    }
+    try:
+        killall_daemon.stdin.write((json.dumps(req) + "\n").encode())
+        killall_daemon.stdin.flush()
+        ack = killall_daemon.stdout.readline()
+    except BrokenPipeError:
+        ack = b""
+    if len(ack) == 0:
+        print("WARN: remote killall daemon exited unexpectedly")
+        return
+    ack = json.loads(ack)
+    if not ack["ok"]:
+        print(f"WARN: remote killall failed: {ack['error']}")
+
+
+def parse_cpu_list(cpu_list):
+    # accepts the kernel's cpulist format, e.g., "0-3,8,10-11"
+    cpus = set()
+    for seg in cpu_list.strip().split(","):
+        if len(seg) == 0:
+            continue
+        if "-" in seg:
+            core_start, core_end = seg.split("-")
+            cpus.update(range(int(core_start), int(core_end) + 1))
+        else:
+            cpus.add(int(seg))
+    return cpus
+
+
+def format_cpu_list(cpus):
+    return ",".join(str(c) for c in sorted(cpus))
 
 
 def run_process(
@@ -44,35 +123,76 @@ def run_process(
     cd_dir=None,
     capture_stdout=False,
     capture_stderr=False,
+    discard_stdout=False,
+    discard_stderr=False,
     print_cmd=True,
     cpu_list=None,
     in_netns=None,
     extra_env=None,
     shell=False,
+    use_sudo_taskset=False,
 ):
     stdout, stderr = None, None
     if capture_stdout:
         stdout = subprocess.PIPE
+    elif discard_stdout:
+        stdout = subprocess.DEVNULL
     if capture_stderr:
         stderr = subprocess.PIPE
+    elif discard_stderr:
+        stderr = subprocess.DEVNULL
 
-    if cpu_list is not None and "-" in cpu_list:
-        cmd = ["sudo", "taskset", "-c", cpu_list] + cmd
+    # pin the child in-process through sched_setaffinity, unless the caller
+    # explicitly asks for the sudo taskset wrapper
+    cpuset = None
+    if cpu_list is not None and len(cpu_list) > 0:
+        if use_sudo_taskset:
+            cmd = ["sudo", "taskset", "-c", cpu_list] + cmd
+        else:
+            cpuset = parse_cpu_list(cpu_list)
 
     if in_netns is not None and len(in_netns) > 0:
         cmd = [s for s in cmd if s != "sudo"]
         cmd = ["sudo", "ip", "netns", "exec", in_netns] + cmd
 
-    env_vars = os.environ.copy()
+    # inherit the parent environment as-is unless extra vars are given
+    env_vars = None
     if extra_env is not None:
-        env_vars.update(extra_env)
+        env_vars = {**os.environ, **extra_env}
 
     if print_cmd:
         print("Run:", " ".join(cmd))
 
-    proc = subprocess.Popen(
-        cmd, cwd=cd_dir, stdout=stdout, stderr=stderr, env=env_vars, shell=shell
-    )
+    # Popen may use posix_spawn instead of fork+exec only for an executable
+    # given with a directory, no cwd, no preexec_fn, and close_fds=False; the
+    # latter is only passed then (our own fds are non-inheritable anyway)
+    can_spawn = not shell and cd_dir is None and len(os.path.dirname(cmd[0])) > 0
+
+    # for pinning, the child inherits the affinity temporarily set on this
+    # process around the spawn, so no preexec_fn is needed
+    parent_cpuset = None
+    if cpuset is not None:
+        parent_cpuset = os.sched_getaffinity(0)
+        allowed = cpuset & parent_cpuset
+        if len(allowed) == 0:
+            raise ValueError(f"cpu_list {cpu_list} has no CPU allowed for this process")
+        if allowed != cpuset:
+            dropped = format_cpu_list(cpuset - allowed)
+            print(f"WARN: CPUs {dropped} of cpu_list {cpu_list} not allowed, dropped")
+        os.sched_setaffinity(0, allowed)
+    try:
+        proc = subprocess.Popen(
+            cmd,
+            cwd=cd_dir,
+            stdout=stdout,
+            stderr=stderr,
+            env=env_vars,
+            shell=shell,
+            close_fds=not can_spawn,
+        )
+    finally:
+        if parent_cpuset is not None:
+            os.sched_setaffinity(0, parent_cpuset)
     return proc
 
 
@@ -82,36 +202,36 @@ def run_process_over_ssh(
     cd_dir=None,
     capture_stdout=False,
     capture_stderr=False,
+    discard_stdout=False,
+    discard_stderr=False,
     print_cmd=True,
     cpu_list=None,
     extra_env=None,
+    multiplex=False,
 ):
     stdout, stderr = None, None
     if capture_stdout:
         stdout = subprocess.PIPE
+    elif discard_stdout:
+        stdout = subprocess.DEVNULL
     if capture_stderr:
         stderr = subprocess.PIPE
+    elif discard_stderr:
+        stderr = subprocess.DEVNULL
 
-    if cpu_list is not None and "-" in cpu_list:
+    if cpu_list is not None and len(cpu_list) > 0:
         cmd = ["sudo", "taskset", "-c", cpu_list] + cmd
 
     if print_cmd:
         print(f"Run on {remote}: {' '.join(cmd)}")
 
-    # ugly hack to solve the quote parsing issue
-    config_seg = False
-    for i, seg in enumerate(cmd):
-        if seg.startswith("--"):
-            if seg.strip() == "--config" or seg.strip() == "--params":
-                config_seg = True
-            else:
-                config_seg = False
-        elif config_seg:
-            new_seg = "\\'".join(seg.split("'"))
-            cmd[i] = new_seg
-            config_seg = False
-
-    str_cmd = " ".join(cmd)
+    # config/params strings carry their own quotes, so quote them for the
+    # remote shell; other segments may rely on shell word splitting (e.g.,
+    # tc's "delay 10ms") and are passed through as-is
+    str_cmd = " ".join(
+        shlex.quote(seg) if i > 0 and cmd[i - 1] in ("--config", "--params") else seg
+        for i, seg in enumerate(cmd)
+    )
     if extra_env is not None:
         extra_env_assigns = [f"{k}={v}" for k, v in extra_env.items()]
         str_cmd = f"{' '.join(extra_env_assigns)} {str_cmd}"
@@ -121,24 +241,34 @@ def run_process_over_ssh(
     else:
         wrapped_cmd = f". ~/.profile; cd {cd_dir}; {str_cmd}"
 
-    ssh_exec_cmd = ["ssh", "-o", "StrictHostKeyChecking=no", remote, wrapped_cmd]
+    ssh_opts = SSH_OPTIONS + SSH_MUX_OPTIONS if multiplex else SSH_OPTIONS
+    ssh_exec_cmd = ["ssh"] + ssh_opts + [remote, wrapped_cmd]
     proc = subprocess.Popen(ssh_exec_cmd, stdout=stdout, stderr=stderr)
     return proc
 
 
 def wait_parallel_procs(procs, names=None, check_rc=True):
-    for i, proc in enumerate(procs):
-        name = f"proc {i}" if names is None else names[i]
-        rc = proc.wait()
-        if check_rc:
-            if rc == 0:
-                print(f"  {name}: OK")
-            else:
-                print(f"  {name}: ERROR")
-                if proc.stdout is not None:
-                    print(proc.stdout.read().decode())
-                if proc.stderr is not None:
-                    print(proc.stderr.read().decode())
+    # reap in completion order; polling only our own children instead of
+    # os.waitpid(-1) so that unrelated children (e.g., servers launched
+    # earlier by the same script) do not get reaped behind Popen's back
+    pending = {i: proc for i, proc in enumerate(procs)}
+    while len(pending) > 0:
+        done = [i for i, proc in pending.items() if proc.poll() is not None]
+        if len(done) == 0:
+            time.sleep(0.01)
+            continue
+        for i in done:
+            proc = pending.pop(i)
+            name = f"proc {i}" if names is None else names[i]
+            if check_rc:
+                if proc.returncode == 0:
+                    print(f"  {name}: OK")
+                else:
+                    print(f"  {name}: ERROR")
+                    if proc.stdout is not None:
+                        print(proc.stdout.read().decode())
+                    if proc.stderr is not None:
+                        print(proc.stderr.read().decode())
 
 
 def get_cpu_count(remote=None):
@@ -159,6 +289,59 @@ def get_cpu_count(remote=None):
     return cpus
 
 
+def get_physical_cores(skip=4):
+    # prefer cores explicitly isolated from the kernel scheduler, if any
+    sys_cpu_dir = "/sys/devices/system/cpu"
+    try:
+        with open(f"{sys_cpu_dir}/isolated") as f:
+            isolated = sorted(parse_cpu_list(f.read()))
+        if len(isolated) > 0:
+            return isolated
+    except OSError:
+        pass
+
+    # otherwise keep only the first hyperthread of each physical core
+    cores = []
+    for name in os.listdir(sys_cpu_dir):
+        if not name.startswith("cpu") or not name[3:].isdigit():
+            continue
+        try:
+            with open(f"{sys_cpu_dir}/{name}/topology/thread_siblings_list") as f:
+                siblings = parse_cpu_list(f.read())
+        except OSError:
+            continue  # offline CPU
+        if int(name[3:]) == min(siblings):
+            cores.append(int(name[3:]))
+    if len(cores) == 0:
+        cores = list(range(get_cpu_count()))
+    cores.sort()
+
+    # leave the first few cores to kernel housekeeping & interrupts
+    if len(cores) > skip:
+        cores = cores[skip:]
+    return cores
+
+
+def get_numa_nodes():
+    sys_node_dir = "/sys/devices/system/node"
+    nodes = []
+    try:
+        names = os.listdir(sys_node_dir)
+    except OSError:
+        names = []
+    node_ids = sorted(
+        int(n[4:]) for n in names if n.startswith("node") and n[4:].isdigit()
+    )
+    for node_id in node_ids:
+        with open(f"{sys_node_dir}/node{node_id}/cpulist") as f:
+            cpus = sorted(parse_cpu_list(f.read()))
+        if len(cpus) > 0:
+            nodes.append(cpus)
+    if len(nodes) == 0:
+        nodes = [list(range(get_cpu_count()))]
+    return nodes
+
+
 def check_enough_cpus(expected, remote=None):
     cpus = get_cpu_count(remote=remote)
     if cpus < expected: